@@ -16,11 +16,28 @@
 # You should have received a copy of the GNU General Public License
 # along with ec2metadata.  If not, see <http://www.gnu.org/licenses/>.
 
+import asyncio
+import concurrent.futures
+import http.client
+import math
+import os
+import random
+import threading
 import time
-import urllib.request
 import urllib.parse
 import urllib.error
 
+try:
+    import aiohttp
+except ImportError:
+    aiohttp = None
+
+try:
+    import urllib3
+except ImportError:
+    urllib3 = None
+
+from collections import deque
 from socket import (has_ipv6, create_connection)
 
 
@@ -31,11 +48,25 @@ class EC2MetadataError(Exception):
 class EC2Metadata:
     """Class for querying metadata from EC2"""
 
+    # Endpoints that cannot change for the lifetime of the instance may
+    # be cached forever, everything else expires after a few minutes
+    _immutable_uris = (
+        'meta-data/ami-id',
+        'meta-data/instance-id',
+        'meta-data/instance-type',
+        'meta-data/placement/',
+        'meta-data/reservation-id'
+    )
+    _response_ttl = 300
+
     def __init__(self, api='2008-02-01'):
         self.api = api
         self.data_categories = ['dynamic/', 'meta-data/']
-        self.duplicate_names = []
-        
+        self.duplicate_names = set()
+        self._api_map_cache = {}
+        self._available_apis = None
+        self._response_cache = {}
+
         self.addr = None
         self._set_ipaddress()
 
@@ -43,39 +74,81 @@ class EC2Metadata:
             msg = 'Could not establish connection to: IMDS'
             raise EC2MetadataError(msg)
 
-        self._set_api_header()
+        # Holds one persistent stdlib connection per thread when urllib3
+        # is not available
+        self._local = threading.local()
+        self._http = None
+        if urllib3:
+            # Reuse one keep-alive connection to the metadata service
+            # instead of opening a new TCP connection per request
+            self._http = urllib3.PoolManager(
+                num_pools=1,
+                maxsize=4,
+                block=False,
+                timeout=urllib3.Timeout(connect=1.0, read=2.0),
+                retries=False
+            )
+
+        # The token is fetched lazily on the first request the service
+        # rejects with 401. A single query against an instance that still
+        # answers IMDSv1 style requests then needs one round trip, not two
+        self.request_header = {}
+        self._token_expiry = math.inf
+        self._token_lock = threading.Lock()
+
+        # The address and API version are invariant between requests,
+        # build the URLs once instead of in every _get call
+        self._token_url = 'http://%s/latest/api/token' % self.addr
+        self._url_base = 'http://%s/%s/' % (self.addr, self.api)
+
         self._reset_meta_options_api_map()
         self._set_meta_options()
 
-    def _add_meta_option(self, path):
-        """Add meta options available under the current path to the options
-           to API map"""
-        options = list(self.meta_options_api_map.keys())
-        value = self._get(path)
+    def _add_meta_option(self, path, value):
+        """Add the meta options found in the listing for the given path to
+           the options to API map and return the sub paths that still need
+           to be visited"""
+        sub_paths = []
         if not value:
-            return None
-        entries = value.split('\n')
+            return sub_paths
+        self._sorted_options_cache = None
+        # splitlines drops the trailing newline of a listing and there is
+        # no empty line guard needed on the entries
+        entries = value.splitlines()
         for item in entries:
-            if item:
-                if item == 'public-keys/':
-                    continue
-                if item[-1] == '/':
-                    self._add_meta_option(path+item)
+            if item == 'public-keys/':
+                continue
+            if item.endswith('/'):
+                sub_paths.append(path+item)
+            else:
+                if (
+                        item not in self.meta_options_api_map and
+                        item not in self.duplicate_names
+                ):
+                    self.meta_options_api_map[item] = path + item
                 else:
-                    if item not in options and item not in self.duplicate_names:
-                        self.meta_options_api_map[item] = path + item
-                    else:
-                        if item in options:
+                    if item in self.meta_options_api_map:
+                        self.duplicate_names.add(item)
+                        existing_path = self.meta_options_api_map[item]
+                        if existing_path not in [
+                                category + item
+                                for category in self.data_categories
+                        ]:
                             # Expand the existing entry
-                            self.duplicate_names.append(item)
-                            existing_path = self.meta_options_api_map[item]
                             new_name = self._expand_name(existing_path)
-                            self.meta_options_api_map[new_name] = existing_path
+                            self.meta_options_api_map[new_name] = \
+                                existing_path
                             del(self.meta_options_api_map[item])
-                        # Construct a new name for the option using the given
-                        # path as name addition
-                        option_name = self._expand_name(path, item)
-                        self.meta_options_api_map[option_name] = path + item
+                        # An entry at the top of a data category keeps
+                        # its plain name, established options such as
+                        # security-groups must not be renamed when a
+                        # deeper duplicate shows up
+                    # Construct a new name for the option using the given
+                    # path as name addition
+                    option_name = self._expand_name(path, item)
+                    self.meta_options_api_map[option_name] = path + item
+
+        return sub_paths
 
     def _expand_name(self, path, endpoint=''):
         """Expand the name of an endpoint with the preceeding entry in the
@@ -89,38 +162,204 @@ class EC2Metadata:
 
         return '-'.join(path_elements[-2:])
 
-    def _get(self, uri):
-        url = 'http://%s/%s/%s' % (self.addr, self.api, uri)
-        data_request = None
-        value = b''
-        data_request = urllib.request.Request(url, headers=self.request_header)
+    def _get(self, uri, retries=2, encoding='utf-8'):
+        cached = self._response_cache.get(uri)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        url = self._url_base + uri
+        if time.monotonic() >= self._token_expiry:
+            self._set_api_header()
+        token_refreshed = False
+        attempt = 0
+        while True:
+            request_header = self.request_header
+            try:
+                value = self._request('GET', url, headers=request_header)
+                break
+            except urllib.error.HTTPError as err:
+                if err.code == 401 and not token_refreshed:
+                    # The service requires token access and we have no
+                    # token yet, or the token was invalidated before its
+                    # TTL ran out. Fetch a token once and retry
+                    self._set_api_header(
+                        request_header.get('X-aws-ec2-metadata-token'))
+                    token_refreshed = True
+                    continue
+                return None
+            except urllib.error.URLError:
+                if attempt == retries:
+                    msg = 'Unable to reach the metadata service for: %s' % uri
+                    raise EC2MetadataError(msg)
+                # Transient failure, back off with jitter before retrying
+                time.sleep(random.uniform(0, 0.2 * 2**attempt))
+                attempt += 1
+
+        value = value.decode(encoding)
+        self._response_cache[uri] = (
+            time.monotonic() + self._ttl_for(uri), value
+        )
+        return value
+
+    async def _get_async(self, session, uri):
+        cached = self._response_cache.get(uri)
+        if cached and time.monotonic() < cached[0]:
+            return cached[1]
+        url = self._url_base + uri
+        token_refreshed = False
         try:
-            value = urllib.request.urlopen(data_request).read()
-        except urllib.error.URLError:
+            while True:
+                request_header = self.request_header
+                async with session.get(
+                        url, headers=request_header) as resp:
+                    if resp.status == 401 and not token_refreshed:
+                        # Fetch a token once and retry, see _get
+                        self._set_api_header(
+                            request_header.get('X-aws-ec2-metadata-token'))
+                        token_refreshed = True
+                        continue
+                    if resp.status >= 400:
+                        return None
+                    # Only directory listings are fetched on this path,
+                    # they are plain ASCII and latin-1 decodes them
+                    # byte for byte without UTF-8 validation
+                    value = (await resp.read()).decode('latin-1')
+                    break
+        except aiohttp.ClientError:
             return None
 
-        return value.decode()
+        self._response_cache[uri] = (
+            time.monotonic() + self._ttl_for(uri), value
+        )
+        return value
+
+    def _get_listing(self, uri):
+        """Return the directory listing for the given uri. Listings are
+           plain ASCII and latin-1 decodes them byte for byte without
+           UTF-8 validation; values such as user-data stay on the default
+           encoding in _get"""
+        return self._get(uri, encoding='latin-1')
+
+    def _fetch_api_versions(self):
+        """Fetch the available API versions, the list cannot change within
+           the lifetime of the process and is only retrieved once"""
+        if self._available_apis is None:
+            url = 'http://%s/' % self.addr
+            request_header = self.request_header
+            try:
+                value = self._request(
+                    'GET', url, headers=request_header).decode()
+            except urllib.error.HTTPError as err:
+                if err.code != 401:
+                    raise
+                # Fetch a token once and retry, see _get
+                self._set_api_header(
+                    request_header.get('X-aws-ec2-metadata-token'))
+                value = self._request(
+                    'GET', url, headers=self.request_header).decode()
+            self._available_apis = value.split('\n')
+        return self._available_apis
+
+    async def _gather_all(self):
+        connector = aiohttp.TCPConnector(limit=32, force_close=False)
+        timeout = aiohttp.ClientTimeout(sock_connect=1.0, sock_read=2.0)
+        async with aiohttp.ClientSession(
+                connector=connector, timeout=timeout) as session:
+            # Walk the tree with an explicit breadth first frontier
+            # rather than recursive coroutines; the listings of a level
+            # are fetched concurrently and the depth of the tree no
+            # longer nests call frames
+            frontier = deque(self.data_categories)
+            while frontier:
+                paths = list(frontier)
+                frontier.clear()
+                values = await asyncio.gather(
+                    *[self._get_async(session, path) for path in paths]
+                )
+                for path, value in zip(paths, values):
+                    frontier.extend(self._add_meta_option(path, value))
+
+    def _request(self, method, url, headers=None):
+        """Issue a request and return the raw response body. Requests are
+           served from the keep-alive connection pool when urllib3 is
+           available and from a persistent per-thread http.client
+           connection otherwise. Failures are raised as urllib errors in
+           both cases."""
+        if self._http is not None:
+            try:
+                response = self._http.request(
+                    method, url, headers=headers, preload_content=True)
+            except urllib3.exceptions.HTTPError as err:
+                raise urllib.error.URLError(err)
+            if response.status >= 400:
+                raise urllib.error.HTTPError(
+                    url, response.status, response.reason, response.headers,
+                    None
+                )
+            return response.data
+        # HTTP/1.1 connections are keep-alive by default, reusing one
+        # connection per thread avoids the TCP handshake per request
+        connection = getattr(self._local, 'connection', None)
+        path = urllib.parse.urlsplit(url).path or '/'
+        for attempt in range(2):
+            if connection is None:
+                # Let http.client derive the port so a bracketed IPv6
+                # address is handled properly
+                connection = http.client.HTTPConnection(
+                    self.addr, timeout=2.0)
+                self._local.connection = connection
+            try:
+                connection.request(method, path, headers=headers or {})
+                response = connection.getresponse()
+                data = response.read()
+                break
+            except (http.client.HTTPException, OSError) as err:
+                # The kept alive socket went stale, reconnect and retry once
+                connection.close()
+                connection = None
+                self._local.connection = None
+                if attempt:
+                    raise urllib.error.URLError(err)
+        if response.status >= 400:
+            raise urllib.error.HTTPError(
+                url, response.status, response.reason,
+                dict(response.getheaders()), None
+            )
+        return data
 
     def _reset_meta_options_api_map(self):
         """Set options that have special semantics"""
+        self._sorted_options_cache = None
         self.meta_options_api_map = {
             'public-keys': 'meta-data/public-keys',
             'user-data': 'user-data'
         }
 
-    def _set_api_header(self):
-        """Set the header to be used in requests to the metadata service"""
-        request = urllib.request.Request(
-            'http://%s/latest/api/token' % self.addr,
-            headers={'X-aws-ec2-metadata-token-ttl-seconds': '21600'},
-            method='PUT'
-        )
-        try:
-            token = urllib.request.urlopen(request).read().decode()
-        except urllib.error.URLError:
-            raise EC2MetadataError('Unable to retrieve metadata token')
+    def _set_api_header(self, rejected_token=None):
+        """Set the header to be used in requests to the metadata service.
+           The token is cached together with its expiry so it is only
+           refetched once its TTL has run out or the service rejected it.
+           Callers recovering from a 401 pass the token that was rejected
+           so concurrent recoveries fetch a replacement only once."""
+        with self._token_lock:
+            token = self.request_header.get('X-aws-ec2-metadata-token')
+            if token and token != rejected_token and \
+                    time.monotonic() < self._token_expiry:
+                # Another thread refreshed the token in the meantime
+                return
+            token_ttl = 21600
+            try:
+                token = self._request(
+                    'PUT',
+                    self._token_url,
+                    headers={'X-aws-ec2-metadata-token-ttl-seconds':
+                             str(token_ttl)}
+                ).decode()
+            except urllib.error.URLError:
+                raise EC2MetadataError('Unable to retrieve metadata token')
 
-        self.request_header = {'X-aws-ec2-metadata-token': token}
+            self.request_header = {'X-aws-ec2-metadata-token': token}
+            # Refresh a little early to cover clock skew between us and IMDS
+            self._token_expiry = time.monotonic() + token_ttl - 60
 
     def _set_ipaddress(self):
         metadata_ip_addrs = {
@@ -135,26 +374,72 @@ class EC2Metadata:
         # Python keeps the order in which entries were added to a dictionary
         # therefore we comply with the RFC and try IPv6 first
         for ip_family, ip_addr in metadata_ip_addrs.items():
-            for i in range(3):
-                try:
-                    socket = create_connection((ip_addr, 80), timeout=1)
-                    socket.close()
-                    if ip_family == 'ipv6_addr':
-                        # Make the IPv6 address http friendly
-                        self.addr = '[%s]' % ip_addr
-                    else:
-                        self.addr = ip_addr
-                except OSError:
-                    # Cannot reach the network
-                    break
-                except TimeoutError:
-                    # Not ready yet wait a little bit
-                    time.sleep(1)
+            if self._test_connectivity(ip_addr):
+                if ip_family == 'ipv6_addr':
+                    # Make the IPv6 address http friendly
+                    self.addr = '[%s]' % ip_addr
+                else:
+                    self.addr = ip_addr
+                return
+
+    def _test_connectivity(self, addr, port=80):
+        """Check whether the metadata service answers on the given address.
+           A single connect with a timeout detects both reachable and
+           unreachable addresses; only timeouts are retried, backing off
+           with jitter so many instances starting at once do not hit the
+           service in lockstep."""
+        for attempt in range(5):
+            try:
+                connection = create_connection((addr, port), timeout=1.0)
+                connection.close()
+                return True
+            except TimeoutError:
+                # Not ready yet, wait a little bit
+                time.sleep(random.uniform(0, min(2.0, 0.1 * 2**attempt)))
+            except OSError:
+                # Cannot reach the network
+                return False
+
+        return False
 
     def _set_meta_options(self):
-        """Set the metadata options for the current API on this object."""
-        for path in self.data_categories:
-            self._add_meta_option(path)
+        """Set the metadata options for the current API on this object.
+
+           The option tree is walked breadth first with the directory
+           listings fetched in parallel; the listings themselves are parsed
+           serially in this thread so the options to API map needs no
+           locking. When aiohttp is available a single keep-alive session
+           on the event loop serves the whole walk, otherwise the fetches
+           are spread over a thread pool."""
+        if aiohttp:
+            asyncio.run(self._gather_all())
+            self._api_map_cache[self.api] = dict(self.meta_options_api_map)
+            return
+        max_workers = min(32, (os.cpu_count() or 1) + 4)
+        with concurrent.futures.ThreadPoolExecutor(max_workers) as executor:
+            pending = {
+                executor.submit(self._get_listing, path): path
+                for path in self.data_categories
+            }
+            while pending:
+                done, _ = concurrent.futures.wait(
+                    pending, return_when=concurrent.futures.FIRST_COMPLETED
+                )
+                for future in done:
+                    path = pending.pop(future)
+                    for sub_path in self._add_meta_option(
+                            path, future.result()):
+                        pending[executor.submit(
+                            self._get_listing, sub_path)] = sub_path
+
+        self._api_map_cache[self.api] = dict(self.meta_options_api_map)
+
+    def _ttl_for(self, uri):
+        """Return the time a response for the given uri may be cached"""
+        for immutable_uri in self._immutable_uris:
+            if uri.startswith(immutable_uri):
+                return math.inf
+        return self._response_ttl
 
     def get(self, metaopt):
         """Return value of metaopt"""
@@ -170,9 +455,15 @@ class EC2Metadata:
                 return public_keys
 
             keyids = [line.split('=')[0] for line in data.splitlines()]
-            for keyid in keyids:
-                uri = 'meta-data/public-keys/%d/openssh-key' % int(keyid)
-                public_keys.append(self._get(uri).rstrip())
+            key_uris = [
+                'meta-data/public-keys/%d/openssh-key' % int(keyid)
+                for keyid in keyids
+            ]
+            # The key fetches are independent, overlap them
+            with concurrent.futures.ThreadPoolExecutor(
+                    min(8, len(key_uris))) as executor:
+                for key in executor.map(self._get, key_uris):
+                    public_keys.append(key.rstrip())
 
             return public_keys
 
@@ -180,30 +471,35 @@ class EC2Metadata:
 
     def get_available_api_versions(self):
         """Return a list of the available API versions"""
-        url = 'http://%s/' % self.addr
-        req = urllib.request.Request(url, headers=self.request_header)
-        value = urllib.request.urlopen(req).read().decode()
-        apiVers = value.split('\n')
-        return apiVers
+        return list(self._fetch_api_versions())
 
     def get_meta_data_options(self):
         """Return the available options for the current api version"""
-        options = list(self.meta_options_api_map.keys())
-        options.sort()
-        return options
+        if self._sorted_options_cache is None:
+            self._sorted_options_cache = tuple(
+                sorted(self.meta_options_api_map)
+            )
+        # Return a fresh list, callers are free to modify it
+        return list(self._sorted_options_cache)
 
     def set_api_version(self, api_version=None):
         """Set the API version to use for the query"""
         if not api_version:
             # Nothing to do
             return self.api
-        url = 'http://%s' % self.addr
-        req = urllib.request.Request(url, headers=self.request_header)
-        meta_apis = urllib.request.urlopen(req).read().decode().split('\n')
-        if api_version not in meta_apis:
+        if api_version not in self._fetch_api_versions():
             msg = 'Requested API version "%s" not available' % api_version
             raise EC2MetadataError(msg)
         self.api = api_version
+        self._url_base = 'http://%s/%s/' % (self.addr, self.api)
+        # Cached responses are keyed by uri relative to the API version
+        self._response_cache = {}
+        cached_map = self._api_map_cache.get(api_version)
+        if cached_map is not None:
+            # This version was crawled before, no need to do it again
+            self._sorted_options_cache = None
+            self.meta_options_api_map = dict(cached_map)
+            return
         self._reset_meta_options_api_map()
         self._set_meta_options()
 
@@ -33,7 +33,11 @@ def _generate_xml(metadata, metaopts):
 
     xml = ''
     for metaopt in metaopts:
-        value = metadata.get(metaopt)
+        try:
+            value = metadata.get(metaopt)
+        except ec2metadata.EC2MetadataError:
+            # The service could not be reached, treat the value as missing
+            value = None
         if not value:
             value = "unavailable"
         xml += '<%s>' % metaopt
@@ -101,7 +105,11 @@ def write_file(file_path, metadata, metaopts, prefix=False):
 
     data = ''
     for metaopt in metaopts:
-        value = metadata.get(metaopt)
+        try:
+            value = metadata.get(metaopt)
+        except ec2metadata.EC2MetadataError:
+            # The service could not be reached, treat the value as missing
+            value = None
         if not value:
             value = "unavailable"
 
@@ -25,6 +25,10 @@ Group:          System/Management
 Url:            https://github.com/SUSE-Enceladus/ec2metadata
 Source0:        %{upstream_name}-%{version}.tar.bz2
 Requires:       python3
+# Optional, enables the asyncio based option tree crawl
+Recommends:     python3-aiohttp
+# Optional, enables HTTP keep-alive to the metadata service
+Recommends:     python3-urllib3
 BuildRequires:  python3-setuptools
 BuildRoot:      %{_tmppath}/%{name}-%{version}-build
 BuildArch:      noarch